@@ -1,9 +1,14 @@
+import asyncio
+import json
 import pickle
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 import numpy as np
-import pandas as pd
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 import os
+from calendar import monthrange
 from datetime import datetime
 import warnings
 
@@ -11,29 +16,183 @@ import warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 warnings.filterwarnings("ignore", category=FutureWarning)
 
-app = FastAPI()
-
 # --- CONFIGURACIÓN ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 MODEL_DIR = os.path.join(BASE_DIR, "../model")
+# Orden exacto de las columnas en el entrenamiento
+FEATURE_COLUMNS = ["LAT_NORM", "LONG_NORM", "day_sin", "day_cos"]
+
+# Micro-batching: peticiones concurrentes se agrupan en una sola inferencia
+MAX_BATCH = 32
+BATCH_WAIT_S = 0.005
+
+# Hilos de XGBoost por inferencia. Con lotes de <= 32 filas, arrancar el
+# pool de OpenMP cuesta más que lo que se gana paralelizando
+XGB_NTHREAD = int(os.getenv("XGB_NTHREAD", "1"))
+
+# Caché LRU de respuestas, clave = (lat, lon, day, month) cuantizados
+CACHE_MAXSIZE = 4096
+
+# Codificación estacional precalculada: DAY_TRIG[month, day] = (day_sin, day_cos).
+# Usamos el año 2024 (bisiesto) para que no falle si ponen 29 de Feb; las
+# fechas inexistentes (ej: 30 de Febrero) quedan en NaN
+DAY_TRIG = np.full((13, 32, 2), np.nan, dtype=np.float32)
+for _m in range(1, 13):
+    for _d in range(1, monthrange(2024, _m)[1] + 1):
+        _angle = 2 * np.pi * datetime(2024, _m, _d).timetuple().tm_yday / 365.0
+        DAY_TRIG[_m, _d] = (np.sin(_angle), np.cos(_angle))
+
+# Niveles de riesgo: "Medio" si prob > 0.3, "Alto" si > 0.6, "Extremo" si > 0.8
+RISK_LEVELS = ["Bajo", "Medio", "Alto", "Extremo"]
+RISK_THRESHOLDS = np.array([0.3, 0.6, 0.8], dtype=np.float32)
 
 # --- CARGAR MODELO ---
+# Se carga al importar el módulo (no en el lifespan) para que, con
+# `gunicorn --preload`, los workers hereden el modelo ya cargado por fork
 print("Cargando modelo XGBoost...")
 try:
     with open(os.path.join(MODEL_DIR, "modelo_xgb_riesgos.pkl"), "rb") as f:
         model = pickle.load(f)
     with open(os.path.join(MODEL_DIR, "scaler_coords.pkl"), "rb") as f:
         scaler = pickle.load(f)
-    with open(os.path.join(MODEL_DIR, "map_eventos.pkl"), "rb") as f:
-        evento_to_id = pickle.load(f)
+    # MinMaxScaler (clip=False): x_norm = x * scale_ + min_. Guardamos los
+    # coeficientes como floats para no pasar por scaler.transform en cada petición
+    lat_scale, lon_scale = (float(v) for v in scaler.scale_)
+    lat_min, lon_min = (float(v) for v in scaler.min_)
+    with open(os.path.join(MODEL_DIR, "map_eventos.json"), encoding="utf-8") as f:
+        evento_to_id = json.load(f)
         id_to_evento = {v: k for k, v in evento_to_id.items()}
+    # Nombres de evento indexados por id de clase, resueltos una sola vez
+    event_names = [id_to_evento.get(i, f"Evento_{i}") for i in range(model.n_classes_)]
+    ninguno_id = evento_to_id.get("NINGUNO", -1)
     print("XGBoost cargado correctamente.")
 except Exception as e:
     print(f"Error cargando modelo: {e}")
     model = None
 
+# --- CACHÉ ---
+# lru_cache no sirve para corutinas, así que llevamos el LRU a mano
+_prediction_cache = OrderedDict()
+_cache_stats = {"hits": 0, "misses": 0}
+
+def _cache_get(key):
+    predictions = _prediction_cache.get(key)
+    if predictions is None:
+        _cache_stats["misses"] += 1
+        return None
+    _prediction_cache.move_to_end(key)
+    _cache_stats["hits"] += 1
+    return predictions
+
+def _cache_put(key, predictions):
+    _prediction_cache[key] = predictions
+    if len(_prediction_cache) > CACHE_MAXSIZE:
+        _prediction_cache.popitem(last=False)
+
+# --- MICRO-BATCHING ---
+class _BatchBuffer:
+    """Filas de un lote preasignadas (SoA) y los futures que esperan cada fila."""
+
+    def __init__(self):
+        self.features = np.empty((MAX_BATCH, len(FEATURE_COLUMNS)), dtype=np.float32)
+        self.futures = []
+
+class _Batcher:
+    """Agrupa las peticiones pendientes y ejecuta una sola inferencia por lote.
+
+    Cada petición escribe su fila directamente en el buffer que se está
+    llenando; el worker lo intercambia por el de repuesto y pasa a ``infer``
+    la vista ``features[:n]``, sin copias ni np.stack. Todo ocurre en el event
+    loop, así que no hace falta lock: la inferencia corre en ``executor``
+    sobre un buffer que ya nadie escribe.
+    """
+
+    def __init__(self):
+        self._filling = _BatchBuffer()
+        self._spare = _BatchBuffer()
+        self._ready = asyncio.Event()  # hay filas pendientes
+        self._full = asyncio.Event()   # el lote llegó a MAX_BATCH
+        self._space = asyncio.Event()  # hay hueco en el buffer que se llena
+        self._space.set()
+
+    async def predict(self, features: tuple) -> np.ndarray:
+        while len(self._filling.futures) == MAX_BATCH:
+            self._space.clear()
+            await self._space.wait()
+
+        buf = self._filling
+        buf.features[len(buf.futures)] = features
+        fut = asyncio.get_running_loop().create_future()
+        buf.futures.append(fut)
+
+        self._ready.set()
+        if len(buf.futures) == MAX_BATCH:
+            self._full.set()
+        return await fut
+
+    async def run(self, infer, executor: ThreadPoolExecutor):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._ready.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), BATCH_WAIT_S)
+            except asyncio.TimeoutError:
+                pass
+
+            batch = self._filling
+            self._filling, self._spare = self._spare, batch
+            self._ready.clear()
+            self._full.clear()
+            self._space.set()
+
+            n = len(batch.futures)
+            try:
+                probs = await loop.run_in_executor(executor, infer, batch.features[:n])
+            except Exception as e:
+                for fut in batch.futures:
+                    if not fut.done():
+                        fut.set_exception(e)
+            else:
+                for i, fut in enumerate(batch.futures):
+                    # El cliente pudo haberse desconectado (future cancelado)
+                    if not fut.done():
+                        fut.set_result(probs[i])
+            batch.futures.clear()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.batcher = _Batcher()
+    # Un solo hilo de inferencia: los lotes ya agrupan la concurrencia y así
+    # XGBoost no compite consigo mismo por los núcleos
+    app.state.executor = ThreadPoolExecutor(max_workers=1)
+    worker = None
+    if model is not None:
+        # Llamamos al Booster nativo: inplace_predict evita la validación del
+        # wrapper de sklearn y la construcción de un DMatrix en cada lote
+        booster = model.get_booster()
+        booster.set_param({"nthread": XGB_NTHREAD})
+        infer = booster.inplace_predict
+        # Warmup: unas inferencias con entradas en cero, con los tamaños de
+        # lote extremos y en el mismo hilo que atenderá los lotes (los buffers
+        # del predictor son por hilo). Uvicorn no acepta conexiones hasta que
+        # el lifespan termina, así que /health solo responde ya calentado
+        loop = asyncio.get_running_loop()
+        for _ in range(3):
+            for n in (1, MAX_BATCH):
+                dummy = np.zeros((n, len(FEATURE_COLUMNS)), dtype=np.float32)
+                await loop.run_in_executor(app.state.executor, infer, dummy)
+        worker = asyncio.create_task(app.state.batcher.run(infer, app.state.executor))
+    yield
+    if worker is not None:
+        worker.cancel()
+    app.state.executor.shutdown(wait=False)
+
+app = FastAPI(lifespan=lifespan)
+
 # --- ESQUEMA CORRECTO (Adaptado a tu Go Backend) ---
 class PredictionRequest(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     latitude: float
     longitude: float
     day: int
@@ -42,76 +201,97 @@ class PredictionRequest(BaseModel):
     canton: str = ""
     parroquia: str = ""
 
+class EventProbability(BaseModel):
+    event_type: str
+    probability: float
+    risk_level: str
+
+class PredictionResponse(BaseModel):
+    success: bool
+    predictions: list[EventProbability]
+
 @app.get("/health")
 def health_check():
     if model is None:
         raise HTTPException(status_code=503, detail="Modelo no cargado")
-    return {"status": "online", "model": "XGBoost"}
+    return {
+        "status": "online",
+        "model": "XGBoost",
+        "cache": {**_cache_stats, "size": len(_prediction_cache)},
+    }
+
+def _build_features(lat: float, lon: float, day: int, month: int) -> tuple:
+    """Fila de entrada (LAT_NORM, LONG_NORM, day_sin, day_cos) del modelo."""
+    # 1. CODIFICACIÓN ESTACIONAL DEL DÍA DEL AÑO (tabla precalculada)
+    # Se validan los rangos antes de indexar: un índice negativo no fallaría
+    if not (1 <= month <= 12 and 1 <= day <= 31) or np.isnan(DAY_TRIG[month, day, 0]):
+        raise HTTPException(status_code=400, detail="Fecha inválida (ej: 30 de Febrero)")
+    day_sin, day_cos = DAY_TRIG[month, day]
+
+    # 2. ESCALAR COORDENADAS (misma operación que scaler.transform)
+    lat_norm = lat * lat_scale + lat_min
+    long_norm = lon * lon_scale + lon_min
 
+    # 3. ORDEN EXACTO DEL ENTRENAMIENTO
+    # Se escribe en el buffer float32 del lote: es la precisión con la que
+    # XGBoost compara los umbrales de los árboles
+    return (lat_norm, long_norm, day_sin, day_cos)
+
+def _format_predictions(pred_probs) -> tuple:
+    """Tupla inmutable de (event_type, probability, risk_level), mayor probabilidad primero."""
+    probs = np.asarray(pred_probs)
+
+    # Definir nivel de riesgo básico según probabilidad: con side="left",
+    # searchsorted cuenta cuántos umbrales supera estrictamente cada clase
+    levels = np.searchsorted(RISK_THRESHOLDS, probs, side="left")
+
+    # Si es "NINGUNO", el riesgo suele ser bajo a menos que sea muy incierto
+    if 0 <= ninguno_id < len(probs) and probs[ninguno_id] > 0.5:
+        levels[ninguno_id] = 0
+
+    # Ordenar: Mayor probabilidad primero (estable, como list.sort)
+    order = np.argsort(-probs, kind="stable")
+    return tuple(
+        (event_names[i], float(probs[i]), RISK_LEVELS[levels[i]])
+        for i in order
+    )
+
+# Con el tipo de retorno declarado, FastAPI serializa la respuesta
+# directamente con Pydantic (núcleo en Rust) en vez de jsonable_encoder + json
 @app.post("/predict")
-def predict_risk(request: PredictionRequest):
+async def predict_risk(request: PredictionRequest) -> PredictionResponse:
     if not model:
         raise HTTPException(status_code=500, detail="Modelo no disponible")
 
     try:
-        # 1. CALCULAR DÍA DEL AÑO
-        # Usamos el año 2024 (bisiesto) para que no falle si ponen 29 de Feb
-        try:
-            date_obj = datetime(2024, request.month, request.day)
-            day_of_year = date_obj.timetuple().tm_yday
-        except ValueError:
-             raise HTTPException(status_code=400, detail="Fecha inválida (ej: 30 de Febrero)")
-
-        # 2. TRANSFORMACIÓN TRIGONOMÉTRICA
-        day_sin = np.sin(2 * np.pi * day_of_year / 365.0)
-        day_cos = np.cos(2 * np.pi * day_of_year / 365.0)
-
-        # 3. ESCALAR COORDENADAS
-        # El scaler espera [[lat, long]]
-        coords_raw = np.array([[request.latitude, request.longitude]])
-        coords_norm = scaler.transform(coords_raw)
-        lat_norm = coords_norm[0][0]
-        long_norm = coords_norm[0][1]
-
-        # 4. PREPARAR DATAFRAME (Orden exacto del entrenamiento)
-        features = pd.DataFrame([[lat_norm, long_norm, day_sin, day_cos]], 
-                                columns=["LAT_NORM", "LONG_NORM", "day_sin", "day_cos"])
-
-        # 5. PREDICCIÓN
-        pred_probs = model.predict_proba(features)[0]
-        
-        # Formatear respuesta para que coincida con lo que espera Go
-        predictions_list = []
-        
-        # Recorremos todas las clases para devolver sus probabilidades
-        for i, prob in enumerate(pred_probs):
-            event_name = id_to_evento.get(i, f"Evento_{i}")
-            
-            # Definir nivel de riesgo básico según probabilidad
-            risk_level = "Bajo"
-            if prob > 0.3: risk_level = "Medio"
-            if prob > 0.6: risk_level = "Alto"
-            if prob > 0.8: risk_level = "Extremo"
-            
-            # Si es "NINGUNO", el riesgo suele ser bajo a menos que sea muy incierto
-            if event_name == "NINGUNO" and prob > 0.5:
-                risk_level = "Bajo"
-
-            predictions_list.append({
-                "event_type": event_name,
-                "probability": float(prob),
-                "risk_level": risk_level
-            })
-
-        # Ordenar: Mayor probabilidad primero
-        predictions_list.sort(key=lambda x: x["probability"], reverse=True)
-
-        return {
-            "success": True,
-            "predictions": predictions_list
-        }
+        # Cuantizamos a 3 decimales (~100 m) para que coordenadas cercanas
+        # compartan entrada en la caché
+        key = (
+            round(request.latitude, 3),
+            round(request.longitude, 3),
+            request.day,
+            request.month,
+        )
+        predictions = _cache_get(key)
+
+        if predictions is None:
+            features = _build_features(*key)
+
+            # 4. PREDICCIÓN (en lote con las demás peticiones concurrentes)
+            predictions = _format_predictions(await app.state.batcher.predict(features))
+            _cache_put(key, predictions)
+
+        return PredictionResponse(
+            success=True,
+            predictions=[
+                EventProbability(event_type=name, probability=prob, risk_level=level)
+                for name, prob, level in predictions
+            ],
+        )
 
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         traceback.print_exc()
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))